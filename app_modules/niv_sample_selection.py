@@ -1,8 +1,20 @@
+import contextlib
+import glob
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+import threading
+import time
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 from tabulate import tabulate
 from pandas.api.types import is_numeric_dtype as pind
+from app_modules.ranking_module import RankIndex
 warnings.filterwarnings("ignore")
 
 
@@ -38,6 +50,13 @@ class Universe_Structure:
                               'city': self.city_info_cols,
                               'detailed': self.detailed_info_cols}
 
+        self.dimension_settings = {'State_ID': 'State',
+                                   'City_ID': 'City',
+                                   'Player_ID': 'Player',
+                                   'Subplayer_ID': 'Subplayer'}
+        self.id_cols = list(self.dimension_settings.keys())
+        self.fact_cols = ['SHO_ID', 'ACV'] + self.id_cols
+
     def players_help(self):
 
         print(
@@ -102,35 +121,198 @@ class Universe_Structure:
                     print(f'Unexpected {err=}, {type(err)=}')
                     return False
 
-    def acv_structure(self, structure_case: str, universe_acv: int):
+    def rule_summary(self, rule: str, column: str, rule_mask, n_examples: int):
 
-        weight_col_name = f'{structure_case.title()} ACV Weight (%)'
-        cumsum_col_name = f'{structure_case.title()} ACV Cumm Sum (%)'
+        rule_mask = np.asarray(rule_mask, dtype=bool)
+        if 'SHO_ID' in self.data.columns:
+            example_ids = self.data['SHO_ID'].to_numpy()[rule_mask][:n_examples]
+        else:
+            example_ids = self.data.index.to_numpy()[rule_mask][:n_examples]
+
+        return [rule, column, int(rule_mask.sum()), example_ids.tolist()]
+
+    def validate(self, n_examples: int = 5):
+
+        n_rows = self.data.shape[0]
+        report_ls = []
+
+        missing_cols = [col for col in self.necessary_columns.keys()
+                        if col not in self.data.columns]
+        for missing_col in missing_cols:
+            report_ls.append(['Missing column', missing_col, n_rows, []])
+
+        if 'SHO_ID' in self.data.columns:
+            sho_id = self.data['SHO_ID']
+            report_ls.append(self.rule_summary(
+                'Null ID', 'SHO_ID', sho_id.isna(), n_examples))
+            report_ls.append(self.rule_summary(
+                'Duplicate ID', 'SHO_ID', sho_id.notna() & sho_id.duplicated(keep=False), n_examples))
+
+        if 'ACV' in self.data.columns:
+            acv = self.data['ACV']
+            if not pind(acv):
+                numeric_acv = pd.to_numeric(acv, errors='coerce')
+                report_ls.append(self.rule_summary(
+                    'Non-numeric ACV', 'ACV', numeric_acv.isna() & acv.notna(), n_examples))
+                acv = numeric_acv
+            report_ls.append(self.rule_summary(
+                'Null ACV', 'ACV', acv.isna(), n_examples))
+            report_ls.append(self.rule_summary(
+                'Negative ACV', 'ACV', acv < 0, n_examples))
+
+        for id_col, name_col in self.dimension_settings.items():
+            if id_col not in self.data.columns:
+                continue
+            id_values = self.data[id_col]
+            report_ls.append(self.rule_summary(
+                'Null ID', id_col, id_values.isna(), n_examples))
+            if name_col in self.data.columns:
+                report_ls.append(self.rule_summary(
+                    'ID with several names', id_col,
+                    self.inconsistent_mapping(id_col, name_col), n_examples))
+
+        for child_col, parent_col in [('City_ID', 'State_ID'), ('Subplayer_ID', 'Player_ID')]:
+            if child_col in self.data.columns and parent_col in self.data.columns:
+                report_ls.append(self.rule_summary(
+                    f'{child_col} in several {parent_col}', child_col,
+                    self.inconsistent_mapping(child_col, parent_col), n_examples))
+
+        self.validation_report = pd.DataFrame(
+            report_ls, columns=['Rule', 'Column', 'Rows', 'Sample IDs'])
+
+        return self.validation_report
+
+    def inconsistent_mapping(self, key_col: str, value_col: str):
+
+        keys = self.data[key_col]
+        values = self.data[value_col]
+        first_rows = ~keys.duplicated()
+        first_values = pd.Series(values[first_rows].to_numpy(),
+                                 index=keys[first_rows].to_numpy())
+        expected_values = keys.map(first_values)
+        mismatch = (values != expected_values) & (
+            values.notna() | expected_values.notna())
+
+        return keys.isin(keys[mismatch].unique()) & keys.notna()
+
+    def report_issues(self, n_examples: int = 5):
+
+        validation_report = self.validate(n_examples)
+        issues = validation_report[validation_report['Rows'] > 0]
+        if not issues.empty:
+            print('The universe has data-quality issues that can distort the structure tables: \n')
+            print(tabulate(issues.values.tolist(), headers=issues.columns.tolist()))
+
+        return issues.empty
+
+    def star_schema(self):
+
+        if getattr(self, 'dimension_tables', None) is None:
+            self.fact_table = self.data[self.fact_cols]
+            self.dimension_tables = {}
+            for id_col, name_col in self.dimension_settings.items():
+                first_rows = ~self.data[id_col].duplicated()
+                dimension_df = self.data.loc[first_rows, [id_col, name_col]]
+                dimension_df.reset_index(drop=True, inplace=True)
+                self.dimension_tables[id_col] = dimension_df
+
+        if getattr(self, 'delta_rows', None) or getattr(self, 'removed_ids', None):
+            self.merge_delta_rows()
+
+        return self.fact_table, self.dimension_tables
+
+    def merge_delta_rows(self):
+
+        fact_df = self.fact_table
+        if self.removed_ids:
+            fact_df = fact_df[~fact_df.index.isin(list(self.removed_ids))]
+        if self.delta_rows:
+            fact_df = pd.concat([fact_df] + self.delta_rows)
+
+        self.fact_table = fact_df
+        self.delta_rows = []
+        self.delta_ids = set()
+        self.removed_ids = set()
+
+    def detailed_aggregate(self):
+
+        if getattr(self, 'detailed_agg', None) is None:
+            fact_df, _ = self.star_schema()
+            self.detailed_agg = fact_df.groupby(self.id_cols, dropna=False).agg(
+                ACV=('ACV', 'sum'), Store_Count=('SHO_ID', 'count'))
+            self.detailed_agg.reset_index(inplace=True)
+
+        return self.detailed_agg
+
+    def merge_aggregates(self, aggregate_ls: list):
+
+        detailed_agg = pd.concat(aggregate_ls).groupby(
+            self.id_cols, dropna=False)[['ACV', 'Store_Count']].sum()
+        detailed_agg.reset_index(inplace=True)
+
+        return detailed_agg
+
+    def add_dimension_names(self, gpd_stc: pd.DataFrame, group_cols: list):
+
+        dimension_tables = getattr(self, 'dimension_tables', None)
+        if dimension_tables is None:
+            _, dimension_tables = self.star_schema()
+        for id_col, name_col in self.dimension_settings.items():
+            if name_col in group_cols:
+                names = dimension_tables[id_col].set_index(id_col)[name_col]
+                gpd_stc[name_col] = gpd_stc[id_col].map(names)
+
+        return gpd_stc
+
+    def case_id_cols(self, structure_case: str):
+
+        return [col for col in self.case_settings[structure_case]
+                if col in self.id_cols]
+
+    def rollup_structure(self, structure_case: str):
 
         group_cols = self.case_settings[structure_case]
-        reduced_cols = group_cols + ['ACV']
-        summary_cols = reduced_cols + [weight_col_name, cumsum_col_name]
+        group_id_cols = self.case_id_cols(structure_case)
+        gpd_stc = self.detailed_aggregate().groupby(
+            group_id_cols)[['ACV', 'Store_Count']].sum()
+        gpd_stc.reset_index(inplace=True)
+        gpd_stc = self.add_dimension_names(gpd_stc, group_cols)
+        gpd_stc = gpd_stc[group_cols + ['ACV', 'Store_Count']]
 
-        structure_df = self.data.copy()
-        structure_df = structure_df[reduced_cols]
-        acv_gpd_stc = structure_df.groupby(group_cols).sum()
-        acv_gpd_stc.reset_index(inplace=True)
+        return gpd_stc
+
+    def acv_summary(self, gpd_stc: pd.DataFrame, structure_case: str, universe_acv: int):
+
+        weight_col_name = f'{structure_case.title()} ACV Weight (%)'
+        cumsum_col_name = f'{structure_case.title()} ACV Cumm Sum (%)'
 
-        acv_gpd_stc[weight_col_name] = np.round(
-            (acv_gpd_stc['ACV'] / universe_acv) * 100, 2)
-        acv_gpd_stc.sort_values(
+        gpd_stc[weight_col_name] = np.round(
+            (gpd_stc['ACV'] / universe_acv) * 100, 2)
+        gpd_stc.sort_values(
             weight_col_name, ascending=False, inplace=True)
-        acv_gpd_stc[cumsum_col_name] = np.round(
-            (acv_gpd_stc['ACV'].cumsum() / universe_acv) * 100, 2)
+        gpd_stc[cumsum_col_name] = np.round(
+            (gpd_stc['ACV'].cumsum() / universe_acv) * 100, 2)
+
+        gpd_stc.reset_index(drop=True, inplace=True)
+
+        return gpd_stc
 
-        acv_gpd_stc.reset_index(drop=True, inplace=True)
+    def acv_structure(self, structure_case: str, universe_acv: int):
+
+        weight_col_name = f'{structure_case.title()} ACV Weight (%)'
+        cumsum_col_name = f'{structure_case.title()} ACV Cumm Sum (%)'
+
+        group_cols = self.case_settings[structure_case]
+        summary_cols = group_cols + ['ACV', weight_col_name, cumsum_col_name]
+
+        acv_gpd_stc = self.acv_summary(self.rollup_structure(structure_case),
+                                       structure_case, universe_acv)
         acv_gpd_stc = acv_gpd_stc[summary_cols]
 
         return acv_gpd_stc
 
-    def sample_structure(self, structure_case: str, universe_acv: int, universe_n: int):
-
-        acv = self.acv_structure(structure_case, universe_acv)
+    def structure_summary(self, gpd_stc: pd.DataFrame, structure_case: str, group_cols: list,
+                          universe_acv: int, universe_n: int):
 
         acv_weight_col_name = f'{structure_case.title()} ACV Weight (%)'
         acv_cumsum_col_name = f'{structure_case.title()} ACV Cumm Sum (%)'
@@ -138,63 +320,747 @@ class Universe_Structure:
         n_weight_col_name = f'{structure_case.title()} Stores Weight (%)'
         n_cumsum_col_name = f'{structure_case.title()} Stores Cumm Sum (%)'
 
-        group_cols = self.case_settings[structure_case]
-        reduced_cols = group_cols + ['SHO_ID']
-        summary_cols = reduced_cols + \
-            ['ACV', acv_weight_col_name, acv_cumsum_col_name,
+        summary_cols = group_cols + \
+            ['Store_Count', 'ACV', acv_weight_col_name, acv_cumsum_col_name,
                 n_weight_col_name, n_cumsum_col_name]
 
-        structure_df = self.data.copy()
-        structure_df = structure_df[reduced_cols]
-        n_gpd_stc = structure_df.groupby(group_cols).count()
-        n_gpd_stc.reset_index(inplace=True)
-
-        n_gpd_stc[n_weight_col_name] = np.round(
-            (n_gpd_stc['SHO_ID'] / universe_n) * 100, 2)
-
-        gpd_stc = pd.merge(acv, n_gpd_stc, on=group_cols)
+        gpd_stc = self.acv_summary(gpd_stc, structure_case, universe_acv)
 
+        gpd_stc[n_weight_col_name] = np.round(
+            (gpd_stc['Store_Count'] / universe_n) * 100, 2)
         gpd_stc[n_cumsum_col_name] = np.round(
-            (gpd_stc['SHO_ID'].cumsum() / universe_n) * 100, 2)
+            (gpd_stc['Store_Count'].cumsum() / universe_n) * 100, 2)
 
-        gpd_stc.reset_index(drop=True, inplace=True)
         gpd_stc = gpd_stc[summary_cols]
-        gpd_stc.rename(columns={'SHO_ID': 'Store_Count'}, inplace=True)
 
         return gpd_stc
 
+    def sample_structure(self, structure_case: str, universe_acv: int, universe_n: int):
+
+        group_cols = self.case_settings[structure_case]
+        gpd_stc = self.structure_summary(self.rollup_structure(structure_case), structure_case,
+                                         group_cols, universe_acv, universe_n)
+
+        return gpd_stc
+
+    def fingerprint(self):
+
+        fact_df, dimension_tables = self.star_schema()
+        if fact_df is None:
+            fact_df = self.detailed_aggregate()
+        hasher = hashlib.sha1()
+        for table in [fact_df] + list(dimension_tables.values()):
+            hasher.update(pd.util.hash_pandas_object(
+                table, index=False).to_numpy().tobytes())
+
+        return hasher.hexdigest()
+
+    def city_subset(self, cities: list = None):
+
+        detailed_agg = self.detailed_aggregate()
+        if cities is not None:
+            detailed_agg = detailed_agg[detailed_agg.City_ID.isin(cities)]
+            detailed_agg = detailed_agg.reset_index(drop=True)
+
+        subset_ustc = Universe_Structure(None)
+        subset_ustc.detailed_agg = detailed_agg
+        subset_ustc.fact_table = None
+        subset_ustc.dimension_tables = self.star_schema()[1]
+        if cities is None:
+            subset_ustc.universe_fingerprint = getattr(
+                self, 'universe_fingerprint', None)
+
+        return subset_ustc
+
+    def structure_copy(self):
+
+        structure_ustc = self.city_subset()
+        structure_ustc.universe_acv = self.universe_acv
+        structure_ustc.universe_n = self.universe_n
+        structure_ustc.retail_structure = self.retail_structure.copy()
+        structure_ustc.state_structure = self.state_structure.copy()
+        structure_ustc.city_structure = self.city_structure.copy()
+        structure_ustc.detailed_structure = self.detailed_structure.copy()
+
+        return structure_ustc
+
+    def structure_tables(self):
+
+        self.retail_structure = self.sample_structure(
+            'retailer', self.universe_acv, self.universe_n)
+        self.state_structure = self.sample_structure(
+            'state', self.universe_acv, self.universe_n)
+        self.city_structure = self.sample_structure(
+            'city', self.universe_acv, self.universe_n)
+        self.detailed_structure = self.sample_structure(
+            'detailed', self.universe_acv, self.universe_n)
+
+        structure_df_ls = [self.retail_structure,
+                           self.state_structure,
+                           self.city_structure,
+                           self.detailed_structure]
+
+        return structure_df_ls
+
     def get_structure(self):
 
-        data_check = self.columns_check()
+        if self.data is None:
+            data_check = True
+        else:
+            data_check = self.columns_check()
 
         if data_check:
 
-            self.universe_acv = self.data.ACV.sum()
-            self.universe_n = self.data.SHO_ID.count()
+            if self.data is not None:
+                self.report_issues()
 
-            self.retail_structure = self.sample_structure(
-                'retailer', self.universe_acv, self.universe_n)
-            self.state_structure = self.sample_structure(
-                'state', self.universe_acv, self.universe_n)
-            self.city_structure = self.sample_structure(
-                'city', self.universe_acv, self.universe_n)
-            self.detailed_structure = self.sample_structure(
-                'detailed', self.universe_acv, self.universe_n)
-
-            structure_df_ls = [self.retail_structure,
-                               self.state_structure,
-                               self.city_structure,
-                               self.detailed_structure]
+            if self.data is None:
+                self.universe_acv = self.detailed_agg.ACV.sum()
+                self.universe_n = self.detailed_agg.Store_Count.sum()
+            else:
+                self.universe_acv = self.data.ACV.sum()
+                self.universe_n = self.data.SHO_ID.count()
 
-            return structure_df_ls
+            return self.structure_tables()
 
         else:
             pass
 
+    def apply_delta(self, delta, change_col: str = 'Change'):
+
+        if isinstance(delta, str):
+            delta = pd.read_csv(delta)
+
+        if getattr(self, 'universe_acv', None) is None:
+            if self.get_structure() is None:
+                return None
+
+        if getattr(self, 'dimension_tables', None) is None:
+            self.star_schema()
+        fact_df, dimension_tables = self.fact_table, self.dimension_tables
+        if fact_df is None:
+            print('Universe deltas can only be applied to structures built from store rows.')
+            return None
+        if fact_df.index.name != 'SHO_ID':
+            fact_df = fact_df.set_index('SHO_ID', drop=False)
+            self.fact_table = fact_df
+        if getattr(self, 'delta_rows', None) is None:
+            self.delta_rows = []
+            self.delta_ids = set()
+            self.removed_ids = set()
+
+        change = delta[change_col].astype(str).str.lower()
+        old_ids = delta.loc[change.isin(['remove', 'update']), 'SHO_ID']
+        if any(sho_id in self.delta_ids for sho_id in old_ids):
+            self.merge_delta_rows()
+            fact_df = self.fact_table
+
+        # Deltas only look up their own stores, so the cost follows the delta size.
+        old_ids = [sho_id for sho_id in dict.fromkeys(old_ids) if sho_id not in self.removed_ids]
+        old_positions = fact_df.index.get_indexer_for(old_ids)
+        old_rows = fact_df.iloc[old_positions[old_positions >= 0]]
+        new_rows = delta.loc[change.isin(['add', 'update'])].drop(
+            columns=change_col)
+        for fact_col in self.fact_cols:
+            if fact_col in new_rows and new_rows[fact_col].notna().all():
+                new_rows[fact_col] = new_rows[fact_col].astype(
+                    fact_df[fact_col].dtype)
+
+        delta_ustc = Universe_Structure(new_rows)
+        if not new_rows.empty and not delta_ustc.columns_check():
+            return None
+
+        aggregate_ls = [self.detailed_aggregate()]
+        dimension_tables = dict(dimension_tables)
+        if not old_rows.empty:
+            old_agg = old_rows.groupby(self.id_cols, dropna=False).agg(
+                ACV=('ACV', 'sum'), Store_Count=('SHO_ID', 'count'))
+            aggregate_ls.append((-old_agg).reset_index())
+            self.universe_acv = self.universe_acv - old_rows.ACV.sum()
+            self.universe_n = self.universe_n - old_rows.SHO_ID.count()
+        if not new_rows.empty:
+            aggregate_ls.append(delta_ustc.detailed_aggregate())
+            self.universe_acv = self.universe_acv + new_rows.ACV.sum()
+            self.universe_n = self.universe_n + new_rows.SHO_ID.count()
+            for id_col, dimension_df in delta_ustc.star_schema()[1].items():
+                new_ids = ~dimension_df[id_col].isin(
+                    dimension_tables[id_col][id_col])
+                if new_ids.any():
+                    dimension_df = pd.concat(
+                        [dimension_tables[id_col], dimension_df[new_ids]])
+                    dimension_tables[id_col] = dimension_df.reset_index(
+                        drop=True)
+
+        detailed_agg = self.merge_aggregates(aggregate_ls)
+        detailed_agg = detailed_agg[detailed_agg.Store_Count != 0]
+        self.detailed_agg = detailed_agg.reset_index(drop=True)
+
+        # Updates overwrite their rows in place; removals and adds wait for star_schema.
+        in_place = np.zeros(new_rows.shape[0], dtype=bool)
+        if not new_rows.empty:
+            new_rows = new_rows[self.fact_cols].set_index('SHO_ID', drop=False)
+            if fact_df.index.is_unique and \
+                    (new_rows.dtypes == fact_df[self.fact_cols].dtypes).all():
+                in_place = new_rows.index.isin(old_rows.index) & \
+                    ~new_rows.index.duplicated(keep='last')
+            if in_place.any():
+                update_rows = new_rows[in_place]
+                update_positions = fact_df.index.get_indexer(update_rows.index)
+                for fact_col in self.fact_cols:
+                    fact_df.iloc[update_positions, fact_df.columns.get_loc(fact_col)] = \
+                        update_rows[fact_col].to_numpy()
+
+        self.removed_ids.update(old_rows.index.difference(new_rows.index[in_place]))
+        if not in_place.all():
+            self.delta_rows.append(new_rows[~in_place])
+            self.delta_ids.update(new_rows.index[~in_place])
+        self.dimension_tables = dimension_tables
+
+        self.universe_fingerprint = None
+        self.data = None
+
+        return self.structure_tables()
+
+
+class Chunked_Universe_Structure(Universe_Structure):
+
+    def __init__(self, path: str, chunksize: int = 500000):
+
+        super().__init__(None)
+        self.path = path
+        self.chunksize = chunksize
+        self.read_cols = list(self.necessary_columns.keys())
+
+    def read_chunks(self):
+
+        if str(self.path).lower().endswith('.parquet'):
+            try:
+                import pyarrow.parquet as pq
+            except ImportError as err:
+                print('Reading parquet universes in chunks requires pyarrow. \n'
+                      f'Unexpected {err=}.')
+                return
+            parquet_file = pq.ParquetFile(self.path)
+            for batch in parquet_file.iter_batches(batch_size=self.chunksize,
+                                                   columns=self.read_cols):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(self.path, chunksize=self.chunksize,
+                                   usecols=lambda col: col in self.read_cols)
+
+    def aggregate_chunks(self):
+
+        self.fact_table = None
+        self.detailed_agg = None
+        self.dimension_tables = None
+
+        for chunk in self.read_chunks():
+            chunk_ustc = Universe_Structure(chunk)
+            if not chunk_ustc.columns_check():
+                self.detailed_agg = None
+                self.dimension_tables = None
+                return False
+
+            chunk_agg = chunk_ustc.detailed_aggregate()
+            chunk_dimensions = chunk_ustc.star_schema()[1]
+
+            if self.detailed_agg is None:
+                self.detailed_agg = chunk_agg
+                self.dimension_tables = chunk_dimensions
+            else:
+                self.detailed_agg = self.merge_aggregates(
+                    [self.detailed_agg, chunk_agg])
+                for id_col, dimension_df in chunk_dimensions.items():
+                    dimension_df = pd.concat(
+                        [self.dimension_tables[id_col], dimension_df])
+                    dimension_df = dimension_df[~dimension_df[id_col].duplicated()]
+                    dimension_df.reset_index(drop=True, inplace=True)
+                    self.dimension_tables[id_col] = dimension_df
+
+        return self.detailed_agg is not None
+
+    def star_schema(self):
+
+        if getattr(self, 'dimension_tables', None) is None:
+            self.aggregate_chunks()
+
+        return self.fact_table, self.dimension_tables
+
+    def detailed_aggregate(self):
+
+        if getattr(self, 'detailed_agg', None) is None:
+            self.aggregate_chunks()
+
+        return self.detailed_agg
+
+    def get_structure(self):
+
+        if self.detailed_aggregate() is not None:
+            return super().get_structure()
+
+
+class Structure_Batch:
+
+    universe_extensions = ('.csv', '.parquet', '.xlsx')
+    structure_names = ['retailer', 'state', 'city', 'detailed']
+
+    def __init__(self, universes, output_dir: str = 'structures', n_jobs: int = None,
+                 chunksize: int = 500000):
+
+        self.universe_paths = self.universe_files(universes)
+        self.universe_names = self.output_names(self.universe_paths)
+        self.output_dir = output_dir
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.chunksize = chunksize
+
+    def universe_files(self, universes):
+
+        if isinstance(universes, str):
+            universes = [universes]
+
+        universe_paths = []
+        for universe in universes:
+            if os.path.isdir(universe):
+                universe_paths += [os.path.join(universe, file_name)
+                                   for file_name in sorted(os.listdir(universe))]
+            else:
+                universe_paths += sorted(glob.glob(universe))
+        universe_paths = [path for path in dict.fromkeys(universe_paths)
+                          if path.lower().endswith(self.universe_extensions)]
+
+        # Largest universes go first so the pool finishes close to the slowest file.
+        return sorted(universe_paths, key=os.path.getsize, reverse=True)
+
+    def output_names(self, universe_paths: list):
+
+        if not universe_paths:
+            return {}
+
+        # Names keep the folders below the common root, e.g. MX/traditional and CO/traditional.
+        input_root = os.path.commonpath([os.path.dirname(os.path.abspath(path))
+                                         for path in universe_paths])
+        universe_names = {path: os.path.splitext(os.path.relpath(
+            os.path.abspath(path), input_root))[0].replace(os.sep, '/')
+            for path in universe_paths}
+
+        name_counts = pd.Series(list(universe_names.values())).value_counts()
+        duplicated_names = name_counts[name_counts > 1].index.tolist()
+        if duplicated_names:
+            raise ValueError(f'Universe files would share the output folders {duplicated_names}; '
+                             'keep one file per universe name.')
+
+        return universe_names
+
+    @staticmethod
+    def build_structure(task):
+
+        path, universe_name, output_dir, chunksize = task
+        batch_result = {'Universe': universe_name,
+                        'Size (MB)': np.round(os.path.getsize(path) / 2 ** 20, 2),
+                        'Stores': None, 'ACV': None, 'Seconds': None, 'Status': 'Done'}
+
+        start_time = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if path.lower().endswith('.xlsx'):
+                    ustc = Universe_Structure(pd.read_excel(path))
+                else:
+                    ustc = Chunked_Universe_Structure(path, chunksize=chunksize)
+                structure_df_ls = ustc.get_structure()
+
+            if structure_df_ls is None:
+                batch_result['Status'] = 'Invalid columns'
+            else:
+                universe_dir = os.path.join(output_dir, universe_name)
+                os.makedirs(universe_dir, exist_ok=True)
+                for structure_name, structure_df in zip(Structure_Batch.structure_names,
+                                                        structure_df_ls):
+                    structure_df.to_csv(os.path.join(
+                        universe_dir, f'{structure_name}_structure.csv'), index=False)
+                batch_result['Stores'] = int(ustc.universe_n)
+                batch_result['ACV'] = ustc.universe_acv
+        except Exception as err:
+            batch_result['Status'] = f'Failed: {err}'
+
+        batch_result['Seconds'] = np.round(time.perf_counter() - start_time, 2)
+
+        return batch_result
+
+    def run(self):
+
+        tasks = [(path, self.universe_names[path], self.output_dir, self.chunksize)
+                 for path in self.universe_paths]
+        if not tasks:
+            print('No universe files were found.')
+            return pd.DataFrame()
+
+        start_time = time.perf_counter()
+        if self.n_jobs == 1 or len(tasks) == 1:
+            batch_results = [Structure_Batch.build_structure(task) for task in tasks]
+        else:
+            batch_results = []
+            with ProcessPoolExecutor(max_workers=min(self.n_jobs, len(tasks))) as executor:
+                futures = [executor.submit(Structure_Batch.build_structure, task)
+                           for task in tasks]
+                for future in as_completed(futures):
+                    batch_results.append(future.result())
+                    print(f"{batch_results[-1]['Universe']}: {batch_results[-1]['Status']} "
+                          f"in {batch_results[-1]['Seconds']} s.")
+        wall_time = time.perf_counter() - start_time
+
+        batch_df = pd.DataFrame(batch_results).sort_values(
+            'Seconds', ascending=False, kind='stable').reset_index(drop=True)
+        print(tabulate(batch_df.values.tolist(), headers=batch_df.columns.tolist()))
+        print(f'{len(batch_df)} universes in {np.round(wall_time, 2)} s '
+              f'({np.round(batch_df.Seconds.sum(), 2)} s of universe time, '
+              f'slowest {batch_df.Seconds.max()} s).')
+
+        return batch_df
+
+
+class Structure_Cache:
+
+    def __init__(self, max_size: int = 8):
+
+        self.max_size = max_size
+        self.structures = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get_structure(self, ustc: Universe_Structure, cities: list = None):
+
+        if ustc.data is not None and not ustc.columns_check():
+            return ustc
+
+        if getattr(ustc, 'universe_fingerprint', None) is None:
+            ustc.universe_fingerprint = ustc.fingerprint()
+
+        universe_key = (ustc.universe_fingerprint, None)
+        if cities is None:
+            structure_key = universe_key
+        else:
+            structure_key = (ustc.universe_fingerprint,
+                             tuple(sorted(set(cities))))
+
+        # The lock only guards the LRU dict; structures are built outside it so
+        # one long universe does not block other sessions.
+        with self.lock:
+            universe_stc = self.structures.get(universe_key)
+            subset_stc = self.structures.get(structure_key)
+
+        if universe_stc is None:
+            if ustc.data is not None:
+                ustc.report_issues()
+            universe_stc = ustc.city_subset()
+            universe_stc.get_structure()
+        if subset_stc is None:
+            if structure_key == universe_key:
+                subset_stc = universe_stc
+            else:
+                subset_stc = universe_stc.city_subset(cities)
+                subset_stc.get_structure()
+
+        with self.lock:
+            self.structures.setdefault(universe_key, universe_stc)
+            subset_stc = self.structures.setdefault(structure_key, subset_stc)
+            self.structures.move_to_end(universe_key)
+            self.structures.move_to_end(structure_key)
+            while len(self.structures) > self.max_size:
+                self.structures.popitem(last=False)
+
+        return subset_stc.structure_copy()
+
+
+structure_cache = Structure_Cache()
+
+
+class Structure_Cube:
+
+    def __init__(self, universe: pd.DataFrame, hierarchies: dict = None):
+
+        if hierarchies is None:
+            hierarchies = {'geography': ['State_ID', 'City_ID'],
+                           'retail': ['Player_ID', 'Subplayer_ID']}
+        self.hierarchies = hierarchies
+        self.dims = [dim for levels in hierarchies.values() for dim in levels]
+        self.cuts = {}
+        self.cut_indexes = {}
+        self.city_coverages = {}
+
+        self.universe_ustc = Universe_Structure(universe)
+        if not self.universe_ustc.columns_check():
+            return
+        self.universe_acv = universe.ACV.sum()
+        self.universe_n = universe.SHO_ID.count()
+
+        if set(self.dims) <= set(self.universe_ustc.id_cols):
+            finest_agg = self.universe_ustc.detailed_aggregate().groupby(
+                self.dims, dropna=False)[['ACV', 'Store_Count']].sum()
+        else:
+            finest_agg = universe.groupby(self.dims, dropna=False).agg(
+                ACV=('ACV', 'sum'), Store_Count=('SHO_ID', 'count'))
+        finest_agg.reset_index(inplace=True)
+
+        hierarchy_prefixes = [[tuple(levels[:depth]) for depth in range(len(levels) + 1)]
+                              for levels in hierarchies.values()]
+        cut_dims_ls = [sum(prefixes, ()) for prefixes in itertools.product(*hierarchy_prefixes)]
+        cut_dims_ls.sort(key=len, reverse=True)
+
+        self.cuts[tuple(self.dims)] = finest_agg
+        for cut_dims in cut_dims_ls:
+            if cut_dims in self.cuts:
+                continue
+            parent_df = self.smallest_parent(cut_dims)
+            if cut_dims:
+                cut_df = parent_df.groupby(list(cut_dims), dropna=False)[
+                    ['ACV', 'Store_Count']].sum()
+                cut_df.reset_index(inplace=True)
+            else:
+                cut_df = parent_df[['ACV', 'Store_Count']].sum().to_frame().T
+            self.cuts[cut_dims] = cut_df
+
+    def smallest_parent(self, dims):
+
+        parent_cuts = [cut_df for cut_dims, cut_df in self.cuts.items()
+                       if set(dims) <= set(cut_dims)]
+
+        return min(parent_cuts, key=len)
+
+    def view(self, dims, title: str = None):
+
+        if isinstance(dims, str):
+            structure_case = dims
+            dims = self.universe_ustc.case_id_cols(structure_case)
+            group_cols = self.universe_ustc.case_settings[structure_case]
+        else:
+            dims = list(dims)
+            structure_case = ' x '.join(dim.replace('_ID', '') for dim in dims)
+            group_cols = []
+            for dim in dims:
+                group_cols.append(dim)
+                if dim in self.universe_ustc.dimension_settings:
+                    group_cols.append(self.universe_ustc.dimension_settings[dim])
+
+        if title is not None:
+            structure_case = title
+
+        gpd_stc = self.smallest_parent(dims).groupby(dims)[
+            ['ACV', 'Store_Count']].sum()
+        gpd_stc.reset_index(inplace=True)
+        gpd_stc = self.universe_ustc.add_dimension_names(gpd_stc, group_cols)
+
+        return self.universe_ustc.structure_summary(gpd_stc, structure_case, group_cols,
+                                                    self.universe_acv, self.universe_n)
+
+    def cut_index(self, cut_dims: tuple):
+
+        if cut_dims not in self.cut_indexes:
+            group_cols = []
+            for dim in cut_dims:
+                group_cols.append(dim)
+                if dim in self.universe_ustc.dimension_settings:
+                    group_cols.append(self.universe_ustc.dimension_settings[dim])
+            cut_df = self.universe_ustc.add_dimension_names(
+                self.cuts[cut_dims].copy(), group_cols)
+
+            postings = {}
+            codes = {}
+            for dim in cut_dims:
+                dim_codes, uniques = pd.factorize(cut_df[dim])
+                order = np.argsort(dim_codes, kind='stable')
+                bounds = np.searchsorted(
+                    dim_codes[order], np.arange(len(uniques) + 1))
+                postings[dim] = {value: order[bounds[i]:bounds[i + 1]]
+                                 for i, value in enumerate(uniques)}
+                codes[dim] = (dim_codes + 1, len(uniques) + 1)
+
+            self.cut_indexes[cut_dims] = {
+                'postings': postings,
+                'codes': codes,
+                'keys': {col: cut_df[col].to_numpy() for col in group_cols},
+                'ACV': cut_df['ACV'].to_numpy(dtype=float, na_value=0),
+                'Stores': cut_df['Store_Count'].to_numpy(dtype=float),
+                'city_rank': {}}
+
+        return self.cut_indexes[cut_dims]
+
+    def city_coverage(self, measure: str):
+
+        if measure not in self.city_coverages:
+            measure_col = 'ACV' if measure == 'ACV' else 'Store_Count'
+            universe_total = self.universe_acv if measure == 'ACV' else self.universe_n
+            city_df = self.smallest_parent(['City_ID']).groupby(
+                'City_ID')[measure_col].sum()
+            city_df = city_df.sort_values(ascending=False, kind='stable')
+            self.city_coverages[measure] = (
+                city_df.index.to_numpy(),
+                np.round((city_df.cumsum().to_numpy() / universe_total) * 100, 2))
+
+        return self.city_coverages[measure]
+
+    def filter_values(self, dim: str, values):
+
+        if not isinstance(values, (list, tuple, set, np.ndarray, pd.Series)):
+            values = [values]
+        name_settings = {name_col: id_col for id_col, name_col
+                         in self.universe_ustc.dimension_settings.items()}
+
+        if dim in name_settings:
+            id_col = name_settings[dim]
+            dimension_df = self.universe_ustc.star_schema()[1][id_col]
+            values = dimension_df.loc[dimension_df[dim].isin(
+                values), id_col].tolist()
+            dim = id_col
+
+        return dim, values
+
+    def query(self, dims: list, filters: dict = None, measure: str = 'ACV',
+              coverage: float = None, coverage_measure: str = None):
+
+        filters = dict(self.filter_values(dim, values)
+                       for dim, values in (filters or {}).items())
+        coverage_measure = coverage_measure or measure
+        needed_dims = set(dims) | set(filters)
+        if coverage is not None:
+            needed_dims.add('City_ID')
+
+        cut_dims = min([cut_dims for cut_dims in self.cuts if needed_dims <= set(cut_dims)],
+                       key=lambda cut_dims: len(self.cuts[cut_dims]))
+        cut_idx = self.cut_index(cut_dims)
+
+        positions = None
+        for dim, values in filters.items():
+            value_positions = [cut_idx['postings'][dim].get(value, np.empty(0, dtype=np.int64))
+                               for value in values]
+            value_positions = np.sort(np.concatenate(value_positions)) if value_positions \
+                else np.empty(0, dtype=np.int64)
+            positions = value_positions if positions is None else \
+                np.intersect1d(positions, value_positions, assume_unique=True)
+        if positions is None:
+            positions = np.arange(len(cut_idx['ACV']))
+
+        if coverage is not None:
+            city_ids, city_cumm_share = self.city_coverage(coverage_measure)
+            if coverage_measure not in cut_idx['city_rank']:
+                city_rank = pd.Series(np.arange(len(city_ids)), index=city_ids)
+                cut_idx['city_rank'][coverage_measure] = pd.Series(
+                    cut_idx['keys']['City_ID']).map(city_rank).fillna(len(city_ids)).to_numpy()
+            n_cities = np.searchsorted(city_cumm_share, coverage * 100, side='right')
+            positions = positions[cut_idx['city_rank'][coverage_measure][positions] < n_cities]
+
+        measure_values = cut_idx[measure][positions]
+        if len(dims) < len(cut_dims):
+            group_codes = np.zeros(len(positions), dtype=np.int64)
+            for dim in dims:
+                dim_codes, n_codes = cut_idx['codes'][dim]
+                group_codes = group_codes * n_codes + dim_codes[positions]
+            _, first_index, group_inverse = np.unique(
+                group_codes, return_index=True, return_inverse=True)
+            measure_values = np.bincount(group_inverse, weights=measure_values)
+            positions = positions[first_index]
+
+        order = np.argsort(-measure_values, kind='stable')
+        positions = positions[order]
+        measure_values = measure_values[order]
+
+        group_cols = []
+        for dim in dims:
+            group_cols.append(dim)
+            if dim in self.universe_ustc.dimension_settings:
+                group_cols.append(self.universe_ustc.dimension_settings[dim])
+
+        universe_total = self.universe_acv if measure == 'ACV' else self.universe_n
+        selection_total = measure_values.sum()
+        cumm_values = np.cumsum(measure_values)
+
+        query_dict = {col: cut_idx['keys'][col][positions] for col in group_cols}
+        query_dict[measure] = measure_values
+        query_dict[f'{measure} Share (%)'] = np.round(
+            (measure_values / universe_total) * 100, 2)
+        query_dict[f'{measure} Cumm Share (%)'] = np.round(
+            (cumm_values / universe_total) * 100, 2)
+        query_dict[f'{measure} Share of Selection (%)'] = np.round(
+            (measure_values / selection_total) * 100, 2)
+        query_dict[f'{measure} Cumm Share of Selection (%)'] = np.round(
+            (cumm_values / selection_total) * 100, 2)
+
+        return pd.DataFrame(query_dict)
+
+
+class City_Partition_Executor:
+
+    shared_data = None
+
+    def __init__(self, n_jobs: int = None, partitions_per_job: int = 4):
+
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.partitions_per_job = partitions_per_job
+
+    def city_partitions(self, data: pd.DataFrame, cities: list):
+
+        city_codes = pd.Categorical(data['City_ID'], categories=cities).codes
+        row_order = np.argsort(city_codes, kind='stable')
+        row_order = row_order[city_codes[row_order] >= 0]
+
+        city_sizes = np.bincount(
+            city_codes[city_codes >= 0], minlength=len(cities))
+        city_ends = np.cumsum(city_sizes)
+        n_partitions = max(1, min(len(cities),
+                                  self.n_jobs * self.partitions_per_job))
+        split_rows = np.linspace(0, len(row_order), n_partitions + 1)[1:-1]
+        split_cities = np.unique(np.searchsorted(city_ends, split_rows))
+        row_bounds = np.concatenate(
+            [[0], city_ends[split_cities[split_cities < len(cities) - 1]], [len(row_order)]])
+
+        return row_order, [(lo, hi) for lo, hi in zip(row_bounds[:-1], row_bounds[1:])
+                           if hi > lo]
+
+    @staticmethod
+    def init_worker(shared_data):
+        City_Partition_Executor.shared_data = shared_data
+
+    @staticmethod
+    def run_partition(task):
+        partition_function, lo, hi, kwargs = task
+        data, row_order = City_Partition_Executor.shared_data
+        return partition_function(data.take(row_order[lo:hi]), **kwargs)
+
+    def run(self, partition_function, data: pd.DataFrame, cities: list, **kwargs):
+
+        row_order, row_bounds = self.city_partitions(data, cities)
+        tasks = [(partition_function, lo, hi, kwargs)
+                 for lo, hi in row_bounds]
+
+        if not tasks:
+            return partition_function(data.iloc[:0], **kwargs)
+
+        City_Partition_Executor.shared_data = (data, row_order)
+        try:
+            if self.n_jobs == 1 or len(tasks) == 1:
+                partition_results = [City_Partition_Executor.run_partition(task)
+                                     for task in tasks]
+            elif 'fork' in multiprocessing.get_all_start_methods():
+                # Forked workers inherit shared_data, so the universe is never pickled.
+                with ProcessPoolExecutor(max_workers=self.n_jobs,
+                                         mp_context=multiprocessing.get_context('fork')) as executor:
+                    partition_results = list(executor.map(
+                        City_Partition_Executor.run_partition, tasks))
+            else:
+                with ProcessPoolExecutor(max_workers=self.n_jobs,
+                                         initializer=City_Partition_Executor.init_worker,
+                                         initargs=((data, row_order),)) as executor:
+                    partition_results = list(executor.map(
+                        City_Partition_Executor.run_partition, tasks))
+        finally:
+            City_Partition_Executor.shared_data = None
+
+        return pd.concat(partition_results)
+
 
 class NIV_Structure_Design:
 
-    def __init__(self, data: pd.DataFrame, parameter_acv, parameter_stores, structure, reduction, cities_weight):
+    def __init__(self, data: pd.DataFrame, parameter_acv, parameter_stores, structure, reduction, cities_weight,
+                 structure_cache: Structure_Cache = structure_cache,
+                 universe_ustc: Universe_Structure = None, n_jobs: int = 1):
         # self.parameter = parameter
         self.parameter_acv = parameter_acv
         self.parameter_stores = parameter_stores
@@ -203,19 +1069,45 @@ class NIV_Structure_Design:
         self.cities_weight = cities_weight
 
         self.data = data
-
-        _ustc = Universe_Structure(self.data)
-        self.ustc_df_ls = _ustc.get_structure()
+        self.structure_cache = structure_cache
+        self.n_jobs = n_jobs
+
+        if universe_ustc is None:
+            universe_ustc = Universe_Structure(self.data)
+        self.universe_ustc = universe_ustc
+        _ustc = self.structure_cache.get_structure(self.universe_ustc)
+        self.ustc_df_ls = [_ustc.retail_structure,
+                           _ustc.state_structure,
+                           _ustc.city_structure,
+                           _ustc.detailed_structure]
 
         self.retail_stc = _ustc.retail_structure
         self.state_stc = _ustc.state_structure
         self.city_stc = _ustc.city_structure
 
+        # Cities are sorted by ACV weight, so both cumulative shares are non-decreasing.
+        self.cumm_share_index = {
+            criteria_title: self.city_stc[f'City {criteria_title} Cumm Sum (%)'].to_numpy()
+            for criteria_title in ['ACV', 'Stores']}
+
     def get_closest(self, values_ls: list, constant_value: int):
         def abs_diff_func(list_value): return abs(constant_value - list_value)
         closest_value = min(values_ls, key=abs_diff_func)
         return closest_value
 
+    def get_city_cutoff(self, criteria_title: str, constant_value):
+        cumm_share = self.cumm_share_index[criteria_title]
+        upper_position = np.clip(np.searchsorted(
+            cumm_share, constant_value), 0, len(cumm_share) - 1)
+        lower_position = np.clip(upper_position - 1, 0, len(cumm_share) - 1)
+        lower_diff = np.abs(constant_value - cumm_share[lower_position])
+        upper_diff = np.abs(constant_value - cumm_share[upper_position])
+        closest_value = np.where(lower_diff <= upper_diff,
+                                 cumm_share[lower_position], cumm_share[upper_position])
+        cutoff_position = np.searchsorted(
+            cumm_share, closest_value, side='right')
+        return closest_value, cutoff_position
+
     def set_target_parameters(self, criteria: str, parameter):
         self.criteria = criteria
         # parameter = input(
@@ -337,12 +1229,10 @@ class NIV_Structure_Design:
         self.cities_weight = self.set_principal_cities(
             self.criteria_title, cities_weight=self.cities_weight)
 
-        city_rep = self.city_stc[f'City {self.criteria_title} Cumm Sum (%)'].unique(
-        ).tolist()
-        closest_value = self.get_closest(
-            city_rep, self.cities_weight * 100)
-        selected_cities_df = self.city_stc[self.city_stc[
-            f'City {self.criteria_title} Cumm Sum (%)'] <= closest_value]
+        closest_value, cutoff_position = self.get_city_cutoff(
+            self.criteria_title, self.cities_weight * 100)
+        closest_value = float(closest_value)
+        selected_cities_df = self.city_stc.iloc[:int(cutoff_position)]
         selected_cities_ls = selected_cities_df.City.unique().tolist()
 
         print(
@@ -386,11 +1276,8 @@ class NIV_Structure_Design:
 
         selected_cities = selected_cities_df['City_ID'].unique().tolist()
 
-        cities_data = self.data.copy()
-        cities_data = cities_data[cities_data.City_ID.isin(selected_cities)]
-
-        _sustc = Universe_Structure(cities_data)
-        ssustc_df_ls = _sustc.get_structure()
+        _sustc = self.structure_cache.get_structure(
+            self.universe_ustc, cities=selected_cities)
         city_sample_stc = _sustc.city_structure
 
         if structure.lower() == 'cities':
@@ -409,6 +1296,24 @@ class NIV_Structure_Design:
 
         return city_sample_stc
 
+    @staticmethod
+    def chain_targets(working_df: pd.DataFrame):
+        city_order = pd.factorize(working_df['City_ID'])[0]
+        cities_df = working_df.iloc[np.argsort(city_order, kind='stable')]
+        city_totals = cities_df.groupby('City_ID')[
+            ['ACV', 'Store_Count']].transform('sum')
+
+        cities_df['City ACV Weight (Chains)'] = (
+            cities_df['ACV'] / city_totals['ACV']) * 100
+        cities_df['City Stores Weight (Chains)'] = (
+            cities_df['Store_Count'] / city_totals['Store_Count']) * 100
+        cities_df['Target ACV (Chains)'] = (
+            cities_df['City ACV Weight (Chains)'] / 100) * cities_df['Target ACV (City)']
+        cities_df['Target Stores (Chains)'] = (
+            cities_df['City Stores Weight (Chains)'] / 100) * cities_df['Target Stores (City)']
+
+        return cities_df
+
     def new_sample_structure(self, parameter_acv, parameter_stores, structure, reduction, cities_weight):
         self.parameter_acv = parameter_acv
         self.parameter_stores = parameter_stores
@@ -425,11 +1330,8 @@ class NIV_Structure_Design:
         cities_parameters = selected_cities_df.copy()
         cities_parameters = cities_parameters[parameter_columns]
 
-        cities_data = self.data.copy()
-        cities_data = cities_data[cities_data.City_ID.isin(selected_cities)]
-
-        _sustc = Universe_Structure(cities_data)
-        ssustc_df_ls = _sustc.get_structure()
+        _sustc = self.structure_cache.get_structure(
+            self.universe_ustc, cities=selected_cities)
         detailed_sample_stc = _sustc.detailed_structure
 
         working_df = pd.merge(detailed_sample_stc, cities_parameters,
@@ -438,20 +1340,12 @@ class NIV_Structure_Design:
                                  'Detailed Stores Cumm Sum (%)'],
                         inplace=True)
 
-        city_df_ls = [working_df[working_df.City_ID == city]
-                      for city in working_df.City_ID.unique().tolist()]
-
-        for df in city_df_ls:
-            df['City ACV Weight (Chains)'] = (
-                df['ACV'] / df['ACV'].sum()) * 100
-            df['City Stores Weight (Chains)'] = (
-                df['Store_Count'] / df['Store_Count'].sum()) * 100
-            df['Target ACV (Chains)'] = (
-                df['City ACV Weight (Chains)'] / 100) * df['Target ACV (City)']
-            df['Target Stores (Chains)'] = (
-                df['City Stores Weight (Chains)'] / 100) * df['Target Stores (City)']
-
-        cities_df = pd.concat(city_df_ls)
+        if self.n_jobs == 1:
+            cities_df = self.chain_targets(working_df)
+        else:
+            cities_df = City_Partition_Executor(self.n_jobs).run(
+                NIV_Structure_Design.chain_targets, working_df,
+                cities=working_df['City_ID'].unique().tolist())
 
         cities_df = cities_df.round(
             {'Target Stores (Chains)': 0, 'Target ACV (Chains)': 0})
@@ -467,7 +1361,8 @@ class NIV_Structure_Design:
 
 class NIV_Sample_Selection:
 
-    def __init__(self, data: pd.DataFrame, parameter_acv, parameter_stores, structure, reduction, cities_weight):
+    def __init__(self, data: pd.DataFrame, parameter_acv, parameter_stores, structure, reduction, cities_weight,
+                 rank_index: RankIndex = None, n_jobs: int = 1):
         # self.parameter = parameter
         self.parameter_acv = parameter_acv
         self.parameter_stores = parameter_stores
@@ -477,9 +1372,12 @@ class NIV_Sample_Selection:
         # def __init__(self, data: pd.DataFrame):
 
         self.complete_data = data
+        self.rank_index = rank_index
+        self.n_jobs = n_jobs
 
         _nstd = NIV_Structure_Design(
-            self.complete_data, parameter_acv=self.parameter_acv, parameter_stores=self.parameter_stores, structure=self.structure, reduction=self.reduction, cities_weight=self.cities_weight)
+            self.complete_data, parameter_acv=self.parameter_acv, parameter_stores=self.parameter_stores, structure=self.structure, reduction=self.reduction, cities_weight=self.cities_weight,
+            n_jobs=self.n_jobs)
         self.new_structure = _nstd.new_sample_structure(
             parameter_acv=self.parameter_acv, parameter_stores=self.parameter_stores, structure=self.structure, reduction=self.reduction, cities_weight=self.cities_weight)
         self.cities = self.new_structure.City.unique().tolist()
@@ -491,26 +1389,651 @@ class NIV_Sample_Selection:
         self.cities_data = self.complete_data[self.complete_data.City_ID.isin(
             self.cities_id)]
 
+    def acv_rank_index(self):
+        if self.rank_index is None:
+            self.rank_index = RankIndex(self.complete_data, sort_col='ACV')
+        return self.rank_index
+
+    @staticmethod
+    def select_strata(data: pd.DataFrame, targets: pd.DataFrame,
+                      acv_target: bool = False, rank_index: RankIndex = None):
+        stratum_cols = ['City_ID', 'Subplayer_ID']
+        target_cols = ['Target Stores (Chains)', 'Target ACV (Chains)']
+
+        if rank_index is None:
+            rank_index = RankIndex(data, sort_col='ACV')
+        strata = rank_index.group_index(stratum_cols)['keys']
+        stratum_target = pd.merge(strata, targets, how='left',
+                                  on=stratum_cols)[target_cols].fillna(0)
+
+        n_selected = np.trunc(
+            stratum_target['Target Stores (Chains)'].to_numpy())
+        if acv_target:
+            n_acv = rank_index.group_prefix_count(
+                stratum_cols, stratum_target['Target ACV (Chains)'].to_numpy())
+            n_selected = np.maximum(n_selected, n_acv)
+        positions = rank_index.group_top(stratum_cols, n_selected)
+
+        return data.take(positions)
+
+    def strata_sample(self, acv_target: bool = False):
+        stratum_cols = ['City_ID', 'Subplayer_ID']
+        targets = self.new_structure.drop_duplicates(stratum_cols)
+        targets = targets[stratum_cols +
+                          ['Target Stores (Chains)', 'Target ACV (Chains)']]
+
+        if self.n_jobs == 1:
+            strata_niv = self.select_strata(self.complete_data, targets, acv_target=acv_target,
+                                            rank_index=self.acv_rank_index())
+        else:
+            strata_niv = City_Partition_Executor(self.n_jobs).run(
+                NIV_Sample_Selection.select_strata, self.complete_data,
+                cities=sorted(self.cities_id), targets=targets, acv_target=acv_target)
+
+        strata_niv.reset_index(drop=True, inplace=True)
+        return strata_niv
+
     def structure_preserving_sample(self):
-        nsdf = self.cities_data.loc[self.cities_data['City_ID'].isin(
-            self.cities_id)]
-        subplayer_ls = []
-        for ciudad, subdf in nsdf.groupby('City_ID'):
-            for subplayer, sbpdf in subdf.groupby('Subplayer_ID'):
-                n = int(
-                    self.new_structure.loc[
-                        (self.new_structure['City_ID'] == ciudad) &
-                        (self.new_structure['Subplayer_ID'] == subplayer)
-                    ]['Target Stores (Chains)'].values[0]
-                )
-                sbpdf = sbpdf.nlargest(n, 'ACV')
-                subplayer_ls.append(sbpdf)
-        structure_case_niv = pd.concat(subplayer_ls, ignore_index=True)
+        structure_case_niv = self.strata_sample(acv_target=False)
         return structure_case_niv
 
+    def acv_target_sample(self):
+        acv_target_niv = self.strata_sample(acv_target=True)
+        return acv_target_niv
+
+    def changed_strata(self, previous_universe: pd.DataFrame):
+        stratum_cols = ['City_ID', 'Subplayer_ID']
+        compare_cols = ['SHO_ID'] + stratum_cols + ['ACV']
+
+        universe_df = pd.merge(previous_universe[compare_cols], self.complete_data[compare_cols],
+                               how='outer', on='SHO_ID', suffixes=(' (Old)', ' (New)'),
+                               indicator=True)
+        changed = universe_df['_merge'] != 'both'
+        for col in stratum_cols + ['ACV']:
+            changed |= universe_df[f'{col} (Old)'].ne(universe_df[f'{col} (New)']) & \
+                universe_df[[f'{col} (Old)', f'{col} (New)']].notna().any(axis=1)
+        universe_df = universe_df[changed]
+
+        strata_ls = [universe_df[[f'{col} ({version})' for col in stratum_cols]].set_axis(
+            stratum_cols, axis=1) for version in ['Old', 'New']]
+        strata = pd.concat(strata_ls).dropna().drop_duplicates()
+
+        return strata
+
+    def maintain_sample(self, previous_sample: pd.DataFrame, previous_universe: pd.DataFrame = None,
+                        keep_panel: bool = True):
+        stratum_cols = ['City_ID', 'Subplayer_ID']
+        targets = self.new_structure.drop_duplicates(stratum_cols)
+        targets = targets[stratum_cols + ['Target Stores (Chains)']]
+
+        rank_index = self.acv_rank_index()
+        group_idx = rank_index.group_index(stratum_cols)
+        strata = group_idx['keys']
+        codes = group_idx['codes']
+        n_strata = strata.shape[0]
+
+        n_target = pd.merge(strata, targets, how='left',
+                            on=stratum_cols)['Target Stores (Chains)']
+        n_target = np.trunc(n_target.fillna(0).to_numpy()).astype(np.int64)
+
+        panel_mask = self.complete_data['SHO_ID'].isin(
+            previous_sample['SHO_ID']).to_numpy()
+        panel_codes = codes[panel_mask & (codes >= 0)]
+        n_panel = np.bincount(panel_codes, minlength=n_strata)
+
+        affected = n_panel != np.minimum(n_target, group_idx['sizes'])
+        if previous_universe is not None:
+            changed = pd.merge(strata.reset_index(), self.changed_strata(previous_universe),
+                               on=stratum_cols)['index'].to_numpy()
+            affected[changed] = True
+
+        kept_positions = np.flatnonzero(panel_mask & (codes >= 0))
+        kept_positions = kept_positions[~affected[codes[kept_positions]]]
+
+        affected_positions = rank_index.group_members(stratum_cols, affected)
+        affected_codes = codes[affected_positions]
+        if keep_panel:
+            priority = ~panel_mask[affected_positions]
+        else:
+            priority = np.zeros(len(affected_positions), dtype=bool)
+        affected_order = np.lexsort(
+            (group_idx['group_rank'][affected_positions], priority, affected_codes))
+        affected_positions = affected_positions[affected_order]
+        affected_codes = affected_codes[affected_order]
+        affected_sizes = np.bincount(affected_codes, minlength=n_strata)
+        affected_starts = np.cumsum(affected_sizes) - affected_sizes
+        stratum_place = np.arange(len(affected_positions)) - \
+            affected_starts[affected_codes]
+        selected_positions = affected_positions[stratum_place <
+                                                n_target[affected_codes]]
+
+        positions = np.concatenate([kept_positions, selected_positions])
+        positions = positions[np.lexsort(
+            (group_idx['group_rank'][positions], codes[positions]))]
+
+        n_selected = np.bincount(codes[selected_positions], minlength=n_strata)
+        n_kept = np.bincount(codes[selected_positions[panel_mask[selected_positions]]],
+                             minlength=n_strata)
+        maintenance_report = strata[affected].copy()
+        maintenance_report['Target Stores (Chains)'] = n_target[affected]
+        maintenance_report['Previous Panel'] = n_panel[affected]
+        maintenance_report['Kept'] = n_kept[affected]
+        maintenance_report['Added'] = (n_selected - n_kept)[affected]
+        maintenance_report['Dropped'] = (n_panel - n_kept)[affected]
+        maintenance_report.reset_index(drop=True, inplace=True)
+        self.maintenance_report = maintenance_report
+
+        n_closed = (~previous_sample['SHO_ID'].isin(
+            self.complete_data['SHO_ID'])).sum()
+        print(f'{affected.sum()} of {n_strata} strata were re-selected: '
+              f'{maintenance_report["Added"].sum()} stores were added, '
+              f'{maintenance_report["Dropped"].sum()} were dropped and '
+              f'{n_closed} are no longer in the universe.')
+
+        maintained_niv = self.complete_data.take(positions)
+        maintained_niv.reset_index(drop=True, inplace=True)
+        return maintained_niv
+
+    def refine_sample(self, sample: pd.DataFrame, levels: dict = None,
+                      max_iter: int = 20000, time_limit: float = 30, seed: int = 0):
+        cities_mask = self.complete_data['City_ID'].isin(self.cities_id)
+        _nsr = NIV_Sample_Refinement(self.complete_data[cities_mask], sample,
+                                     levels=levels, seed=seed)
+        refined_sample = _nsr.refine(max_iter=max_iter, time_limit=time_limit)
+
+        self.refinement = _nsr
+        return refined_sample
+
     def acv_maximizing_sample(self):
-        nsdf = self.cities_data.loc[self.cities_data['City_ID'].isin(
-            self.cities_id)]
-        nsdf = nsdf.nlargest(int(self.n_stores), 'ACV')
+        cities_mask = self.complete_data['City_ID'].isin(self.cities_id)
+        positions = self.acv_rank_index().top(int(self.n_stores),
+                                              mask=cities_mask.to_numpy())
+        nsdf = self.complete_data.take(positions)
         nsdf.reset_index(drop=True, inplace=True)
         return nsdf
+
+
+class NIV_Sample_Refinement:
+
+    def __init__(self, pool: pd.DataFrame, sample: pd.DataFrame, levels: dict = None, seed: int = 0):
+
+        if levels is None:
+            levels = {'retailer': 1, 'state': 1}
+
+        self.pool = pool
+        self.levels = levels
+        self.rng = np.random.default_rng(seed)
+        self.pool_acv = pool['ACV'].to_numpy(dtype=float, na_value=0)
+
+        self.sample_slots = pd.Index(pool['SHO_ID']).get_indexer(
+            sample['SHO_ID'])
+        if (self.sample_slots < 0).any():
+            raise ValueError('Every sample store must belong to the selection universe '
+                             '(matched by SHO_ID).')
+        self.in_sample = np.zeros(pool.shape[0], dtype=bool)
+        self.in_sample[self.sample_slots] = True
+        self.sample_total = self.pool_acv[self.sample_slots].sum()
+
+        _ustc = Universe_Structure(None)
+        self.level_settings = []
+        for structure_case, level_weight in levels.items():
+            codes = pool.groupby(_ustc.case_id_cols(structure_case)).ngroup()
+            codes = codes.fillna(-1).to_numpy().astype(np.int64)
+            n_groups = codes.max() + 2
+            codes[codes < 0] = n_groups - 1
+
+            members = np.lexsort((self.pool_acv, codes))
+            sizes = np.bincount(codes, minlength=n_groups)
+            slot_lists = [[] for _ in range(n_groups)]
+            slot_places = np.empty(len(self.sample_slots), dtype=np.int64)
+            for slot, position in enumerate(self.sample_slots):
+                slot_places[slot] = len(slot_lists[codes[position]])
+                slot_lists[codes[position]].append(slot)
+
+            self.level_settings.append({
+                'weight': level_weight,
+                'codes': codes,
+                'universe_share': np.bincount(codes, weights=self.pool_acv,
+                                              minlength=n_groups) / self.pool_acv.sum(),
+                'sample_sum': np.bincount(codes[self.sample_slots],
+                                          weights=self.pool_acv[self.sample_slots],
+                                          minlength=n_groups),
+                'members': members,
+                'member_acv': self.pool_acv[members],
+                'starts': np.cumsum(sizes) - sizes,
+                'sizes': sizes,
+                'slot_lists': slot_lists,
+                'slot_places': slot_places})
+
+    def level_deviation(self, level: dict, sample_total: float):
+
+        if sample_total <= 0:
+            return level['weight'] * 2
+        return level['weight'] * np.abs(level['sample_sum'] / sample_total
+                                        - level['universe_share']).sum()
+
+    def deviation(self):
+
+        return sum(self.level_deviation(level, self.sample_total)
+                   for level in self.level_settings)
+
+    def propose_swap(self):
+
+        level_deviations = np.array([self.level_deviation(level, self.sample_total)
+                                     for level in self.level_settings])
+        if level_deviations.sum() == 0:
+            return None
+        level = self.level_settings[self.rng.choice(
+            len(self.level_settings), p=level_deviations / level_deviations.sum())]
+
+        share_gap = level['sample_sum'] / \
+            self.sample_total - level['universe_share']
+        over_groups = np.flatnonzero(share_gap > 0)
+        under_groups = np.flatnonzero(share_gap < 0)
+        over_groups = [group for group in over_groups if level['slot_lists'][group]]
+        if not over_groups or len(under_groups) == 0:
+            return None
+
+        over_gap = share_gap[over_groups]
+        under_gap = -share_gap[under_groups]
+        over_group = over_groups[self.rng.choice(
+            len(over_groups), p=over_gap / over_gap.sum())]
+        under_group = under_groups[self.rng.choice(
+            len(under_groups), p=under_gap / under_gap.sum())]
+
+        over_slots = level['slot_lists'][over_group]
+        slot = over_slots[self.rng.integers(len(over_slots))]
+
+        start = level['starts'][under_group]
+        size = level['sizes'][under_group]
+        target_acv = self.pool_acv[self.sample_slots[slot]] * \
+            np.exp(self.rng.normal(scale=0.5))
+        nearest = start + np.searchsorted(
+            level['member_acv'][start:start + size], target_acv)
+        for step in range(40):
+            member = nearest + (step // 2 if step % 2 else -(step // 2) - 1)
+            if start <= member < start + size:
+                position = level['members'][member]
+                if not self.in_sample[position]:
+                    return slot, position
+
+        return None
+
+    def swap_deviation(self, slot: int, position: int):
+
+        old_position = self.sample_slots[slot]
+        old_acv = self.pool_acv[old_position]
+        new_acv = self.pool_acv[position]
+        sample_total = self.sample_total - old_acv + new_acv
+
+        deviation = 0
+        for level in self.level_settings:
+            old_group = level['codes'][old_position]
+            new_group = level['codes'][position]
+            level['sample_sum'][old_group] -= old_acv
+            level['sample_sum'][new_group] += new_acv
+            deviation += self.level_deviation(level, sample_total)
+            level['sample_sum'][old_group] += old_acv
+            level['sample_sum'][new_group] -= new_acv
+
+        return deviation
+
+    def apply_swap(self, slot: int, position: int):
+
+        old_position = self.sample_slots[slot]
+        old_acv = self.pool_acv[old_position]
+        new_acv = self.pool_acv[position]
+
+        for level in self.level_settings:
+            old_group = level['codes'][old_position]
+            new_group = level['codes'][position]
+            level['sample_sum'][old_group] -= old_acv
+            level['sample_sum'][new_group] += new_acv
+
+            old_slots = level['slot_lists'][old_group]
+            place = level['slot_places'][slot]
+            old_slots[place] = old_slots[-1]
+            level['slot_places'][old_slots[place]] = place
+            old_slots.pop()
+            level['slot_places'][slot] = len(level['slot_lists'][new_group])
+            level['slot_lists'][new_group].append(slot)
+
+        self.in_sample[old_position] = False
+        self.in_sample[position] = True
+        self.sample_slots[slot] = position
+        self.sample_total = self.sample_total - old_acv + new_acv
+
+    def refine(self, max_iter: int = 20000, time_limit: float = 30):
+
+        start_time = time.perf_counter()
+        self.initial_deviation = self.deviation()
+        current_deviation = self.initial_deviation
+        self.n_swaps = 0
+
+        for iteration in range(max_iter):
+            if current_deviation == 0:
+                break
+            if iteration % 256 == 0 and time.perf_counter() - start_time > time_limit:
+                break
+            swap = self.propose_swap()
+            if swap is None:
+                continue
+            swap_deviation = self.swap_deviation(*swap)
+            if swap_deviation < current_deviation:
+                self.apply_swap(*swap)
+                current_deviation = swap_deviation
+                self.n_swaps += 1
+
+        self.final_deviation = self.deviation()
+        # Each level deviation is an L1 gap between shares, so half of it is a distance.
+        print(f'Weighted ACV distance to the universe went from '
+              f'{np.round(self.initial_deviation * 50, 2)} % to '
+              f'{np.round(self.final_deviation * 50, 2)} % after {self.n_swaps} swaps.')
+
+        refined_sample = self.pool.take(self.sample_slots)
+        refined_sample.reset_index(drop=True, inplace=True)
+        return refined_sample
+
+
+class Structure_Deviation_Scorer:
+
+    def __init__(self, universe: pd.DataFrame, levels: list = None):
+
+        if levels is None:
+            levels = ['retailer', 'state', 'city', 'detailed']
+        self.levels = levels
+
+        self.universe_ustc = Universe_Structure(universe)
+        fact_df = self.universe_ustc.star_schema()[0]
+
+        first_rows = ~fact_df['SHO_ID'].duplicated().to_numpy()
+        self.store_index = pd.Index(fact_df['SHO_ID'].to_numpy()[first_rows])
+        self.store_positions = np.flatnonzero(first_rows)
+        self.acv_values = fact_df['ACV'].to_numpy(dtype=float, na_value=0)
+
+        self.level_settings = {}
+        for structure_case in self.levels:
+            group_cols = self.universe_ustc.case_settings[structure_case]
+            id_cols = self.universe_ustc.case_id_cols(structure_case)
+            grouped = fact_df.groupby(id_cols)
+            codes = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+            keys = grouped.size().reset_index()[id_cols]
+            keys = self.universe_ustc.add_dimension_names(keys, group_cols)
+
+            acv_weight, stores_weight = self.group_weights(
+                codes, np.arange(len(codes)), keys.shape[0])
+            self.level_settings[structure_case] = {'codes': codes,
+                                                   'keys': keys[group_cols],
+                                                   'acv_weight': acv_weight,
+                                                   'stores_weight': stores_weight}
+
+    def group_weights(self, codes, positions, n_groups: int):
+
+        sample_codes = codes[positions]
+        valid = sample_codes >= 0
+        acv_values = self.acv_values[positions]
+        acv_total = acv_values.sum()
+        n_total = len(positions)
+
+        acv_weight = np.bincount(sample_codes[valid], weights=acv_values[valid],
+                                 minlength=n_groups)
+        stores_weight = np.bincount(
+            sample_codes[valid], minlength=n_groups).astype(float)
+        if acv_total != 0:
+            acv_weight = acv_weight / acv_total
+        if n_total != 0:
+            stores_weight = stores_weight / n_total
+
+        return acv_weight, stores_weight
+
+    def sample_positions(self, sample: pd.DataFrame):
+
+        store_matches = self.store_index.get_indexer(sample['SHO_ID'])
+        n_unmatched = int((store_matches < 0).sum())
+        if n_unmatched:
+            print(f'{n_unmatched} sample stores are not in the universe and were not scored.')
+
+        return self.store_positions[store_matches[store_matches >= 0]]
+
+    def level_deviation(self, sample: pd.DataFrame, structure_case: str):
+
+        level = self.level_settings[structure_case]
+        acv_weight, stores_weight = self.group_weights(
+            level['codes'], self.sample_positions(sample), level['keys'].shape[0])
+        case_title = structure_case.title()
+
+        deviation_df = level['keys'].copy()
+        deviation_df[f'Universe {case_title} ACV Weight (%)'] = level['acv_weight'] * 100
+        deviation_df[f'Sample {case_title} ACV Weight (%)'] = acv_weight * 100
+        deviation_df[f'{case_title} ACV Weight Diff (pp)'] = (
+            acv_weight - level['acv_weight']) * 100
+        deviation_df[f'Universe {case_title} Stores Weight (%)'] = level['stores_weight'] * 100
+        deviation_df[f'Sample {case_title} Stores Weight (%)'] = stores_weight * 100
+        deviation_df[f'{case_title} Stores Weight Diff (pp)'] = (
+            stores_weight - level['stores_weight']) * 100
+
+        deviation_df.sort_values(f'Universe {case_title} ACV Weight (%)',
+                                 ascending=False, inplace=True)
+        deviation_df.reset_index(drop=True, inplace=True)
+
+        return deviation_df.round(2)
+
+    def score(self, samples):
+
+        if isinstance(samples, pd.DataFrame):
+            samples = {'Sample': samples}
+        elif not isinstance(samples, dict):
+            samples = {f'Sample {i + 1}': sample for i,
+                       sample in enumerate(samples)}
+
+        score_ls = []
+        for sample_name, sample in samples.items():
+            positions = self.sample_positions(sample)
+            for structure_case, level in self.level_settings.items():
+                acv_weight, stores_weight = self.group_weights(
+                    level['codes'], positions, level['keys'].shape[0])
+                acv_diff = np.abs(acv_weight - level['acv_weight']) * 100
+                stores_diff = np.abs(
+                    stores_weight - level['stores_weight']) * 100
+                score_ls.append({'Sample': sample_name,
+                                 'Level': structure_case,
+                                 'ACV Mean Abs Diff (pp)': acv_diff.mean(),
+                                 'ACV Max Abs Diff (pp)': acv_diff.max(),
+                                 'ACV Distance (%)': acv_diff.sum() / 2,
+                                 'Stores Mean Abs Diff (pp)': stores_diff.mean(),
+                                 'Stores Max Abs Diff (pp)': stores_diff.max(),
+                                 'Stores Distance (%)': stores_diff.sum() / 2})
+
+        return pd.DataFrame(score_ls).round(4)
+
+
+class NIV_Parameter_Sweep:
+
+    worker_sweep = None
+
+    def __init__(self, data: pd.DataFrame, structure_cache: Structure_Cache = structure_cache):
+
+        self.parameter_cols = ['parameter_acv', 'parameter_stores',
+                               'structure', 'reduction', 'cities_weight']
+        self.stratum_cols = ['City_ID', 'Subplayer_ID']
+
+        universe_ustc = Universe_Structure(data)
+        self.universe_stc = structure_cache.get_structure(universe_ustc)
+
+        fact_df = universe_ustc.star_schema()[0]
+        fact_df = fact_df.sort_values(self.stratum_cols + ['ACV'],
+                                      ascending=[True, True, False],
+                                      kind='stable', na_position='last')
+        strata = fact_df.groupby(self.stratum_cols).size()
+        self.strata = strata.rename('Stratum_Size').reset_index()
+        self.strata['Stratum_Start'] = self.strata['Stratum_Size'].cumsum() - \
+            self.strata['Stratum_Size']
+        self.cumm_acv = np.concatenate(
+            [[0], np.cumsum(fact_df['ACV'].fillna(0).to_numpy())])
+
+        detailed_agg = self.universe_stc.detailed_aggregate()
+        self.universe_acv = self.universe_stc.universe_acv
+        self.retail_weights = detailed_agg.groupby(
+            ['Player_ID', 'Subplayer_ID'])['ACV'].sum() / self.universe_acv
+        self.state_weights = detailed_agg.groupby(
+            'State_ID')['ACV'].sum() / self.universe_acv
+
+    def grid_points(self, parameter_grid):
+
+        if isinstance(parameter_grid, dict):
+            grid_values = [parameter_grid[col] for col in self.parameter_cols]
+            return [dict(zip(self.parameter_cols, combination))
+                    for combination in itertools.product(*grid_values)]
+
+        return [dict(point) for point in parameter_grid]
+
+    def structure_deviation(self, sample_acv: pd.Series, universe_weights: pd.Series):
+
+        if sample_acv.sum() == 0:
+            return np.nan
+        sample_weights = sample_acv / sample_acv.sum()
+        deviation = sample_weights.sub(
+            universe_weights, fill_value=0).abs().sum() / 2
+
+        return np.round(deviation * 100, 2)
+
+    def evaluate(self, parameters: dict):
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            _nstd = NIV_Structure_Design(
+                None, **parameters, universe_ustc=self.universe_stc)
+            new_structure = _nstd.new_sample_structure(**parameters)
+
+        design_df = pd.merge(new_structure, self.strata,
+                             how='left', on=self.stratum_cols)
+        stratum_size = design_df['Stratum_Size'].fillna(0).to_numpy()
+        stratum_start = design_df['Stratum_Start'].fillna(
+            0).to_numpy().astype(int)
+        n_selected = np.clip(np.trunc(
+            design_df['Target Stores (Chains)'].fillna(0).to_numpy()), 0, stratum_size).astype(int)
+        design_df['Sample ACV'] = self.cumm_acv[stratum_start + n_selected] - \
+            self.cumm_acv[stratum_start]
+
+        sample_acv = design_df['Sample ACV'].sum()
+        retail_acv = design_df.groupby(
+            ['Player_ID', 'Subplayer_ID'])['Sample ACV'].sum()
+        state_acv = design_df.groupby('State_ID')['Sample ACV'].sum()
+
+        sweep_point = dict(parameters)
+        sweep_point['Sample Size'] = int(n_selected.sum())
+        sweep_point['Sample ACV'] = sample_acv
+        sweep_point['ACV Coverage (%)'] = np.round(
+            (sample_acv / self.universe_acv) * 100, 2)
+        sweep_point['Cities'] = new_structure.City_ID.nunique()
+        sweep_point['Retailer Deviation (%)'] = self.structure_deviation(
+            retail_acv, self.retail_weights)
+        sweep_point['State Deviation (%)'] = self.structure_deviation(
+            state_acv, self.state_weights)
+
+        return sweep_point
+
+    @staticmethod
+    def init_worker(sweep):
+        NIV_Parameter_Sweep.worker_sweep = sweep
+
+    @staticmethod
+    def evaluate_point(parameters: dict):
+        return NIV_Parameter_Sweep.worker_sweep.evaluate(parameters)
+
+    def run(self, parameter_grid, n_jobs: int = None):
+
+        sweep_points = self.grid_points(parameter_grid)
+        n_jobs = n_jobs or os.cpu_count() or 1
+
+        if n_jobs == 1:
+            sweep_results = [self.evaluate(parameters)
+                             for parameters in sweep_points]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=NIV_Parameter_Sweep.init_worker,
+                                     initargs=(self,)) as executor:
+                chunksize = max(1, len(sweep_points) // (4 * n_jobs))
+                sweep_results = list(executor.map(NIV_Parameter_Sweep.evaluate_point,
+                                                  sweep_points, chunksize=chunksize))
+
+        return pd.DataFrame(sweep_results)
+
+
+class NIV_Selection_Job:
+
+    sample_methods = {'Structure preserving': 'structure_preserving_sample',
+                      'ACV target': 'acv_target_sample',
+                      'ACV maximizing': 'acv_maximizing_sample'}
+
+    def __init__(self, data: pd.DataFrame, parameter_acv, parameter_stores, structure, reduction, cities_weight,
+                 sample_method: str = 'Structure preserving', n_jobs: int = 1):
+
+        if sample_method not in self.sample_methods:
+            raise ValueError(
+                f'Unknown sample method {sample_method!r}; use one of {list(self.sample_methods)}.')
+
+        self.data = data
+        self.parameters = {'parameter_acv': parameter_acv,
+                           'parameter_stores': parameter_stores,
+                           'structure': structure,
+                           'reduction': reduction,
+                           'cities_weight': cities_weight}
+        self.sample_method = sample_method
+        self.n_jobs = n_jobs
+
+        self.progress = 0.0
+        self.status = 'Queued'
+        self.selection = None
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def design_step(self):
+        self.selection = NIV_Sample_Selection(self.data, **self.parameters,
+                                              n_jobs=self.n_jobs)
+
+    def rank_step(self):
+        self.selection.acv_rank_index()
+
+    def sample_step(self):
+        self.result = getattr(self.selection,
+                              self.sample_methods[self.sample_method])()
+
+    def run(self):
+
+        job_steps = [(0.05, 'Building the NIV sample structure', self.design_step),
+                     (0.60, 'Ranking stores by ACV', self.rank_step),
+                     (0.80, 'Selecting the sample', self.sample_step)]
+        start_time = time.perf_counter()
+        try:
+            for progress, status, job_step in job_steps:
+                if self.cancel_event.is_set():
+                    self.status = 'Cancelled'
+                    return
+                self.progress = progress
+                self.status = status
+                job_step()
+
+            if self.cancel_event.is_set():
+                self.result = None
+                self.status = 'Cancelled'
+                return
+            self.progress = 1.0
+            self.status = 'Done'
+        except Exception as error:
+            self.error = error
+            self.status = 'Failed'
+        finally:
+            self.elapsed = time.perf_counter() - start_time
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_running(self):
+        return self.thread.is_alive()
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+class RankIndex:
+
+    def __init__(self, data: pd.DataFrame, sort_col: str = 'ACV'):
+        self.data = data
+        self.sort_col = sort_col
+        self.n_rows = data.shape[0]
+
+        if sort_col == '' or sort_col is None:
+            self.order = np.arange(self.n_rows)
+        else:
+            sort_values = data[sort_col].reset_index(drop=True)
+            sort_values = sort_values.sort_values(ascending=False, kind='stable',
+                                                  na_position='last')
+            self.order = sort_values.index.to_numpy()
+
+        self.rank = np.empty(self.n_rows, dtype=np.int64)
+        self.rank[self.order] = np.arange(self.n_rows)
+        self.group_indexes = {}
+
+    def top(self, k: int = None, mask=None):
+        if mask is None:
+            return self.order[:k]
+
+        mask = np.asarray(mask, dtype=bool)
+        if k is None:
+            return self.order[mask[self.order]]
+
+        selected_ls = []
+        n_selected = 0
+        start = 0
+        block = max(2 * k, 1024)
+        while n_selected < k and start < self.n_rows:
+            block_order = self.order[start:start + block]
+            block_selected = block_order[mask[block_order]]
+            selected_ls.append(block_selected)
+            n_selected += len(block_selected)
+            start += block
+            block *= 2
+
+        if not selected_ls:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(selected_ls)[:k]
+
+    def group_index(self, group_cols: list):
+        group_key = tuple(group_cols)
+
+        if group_key not in self.group_indexes:
+            grouped = self.data.groupby(group_cols)
+            keys = grouped.size().reset_index()[group_cols]
+            codes = grouped.ngroup().fillna(-1).to_numpy().astype(np.int64)
+
+            positions = np.lexsort((self.rank, codes))
+            positions = positions[codes[positions] >= 0]
+            sizes = np.bincount(codes[positions], minlength=keys.shape[0])
+            starts = np.cumsum(sizes) - sizes
+
+            group_rank = np.full(self.n_rows, -1, dtype=np.int64)
+            group_rank[positions] = np.arange(
+                len(positions)) - np.repeat(starts, sizes)
+
+            self.group_indexes[group_key] = {'keys': keys,
+                                             'codes': codes,
+                                             'positions': positions,
+                                             'starts': starts,
+                                             'sizes': sizes,
+                                             'group_rank': group_rank}
+
+        return self.group_indexes[group_key]
+
+    def group_top(self, group_cols: list, n_per_group):
+        group_idx = self.group_index(group_cols)
+        n_per_group = np.clip(np.asarray(n_per_group, dtype=np.int64),
+                              0, group_idx['sizes'])
+
+        n_total = n_per_group.sum()
+        group_offsets = np.repeat(group_idx['starts'], n_per_group)
+        within_group = np.arange(n_total) - \
+            np.repeat(np.cumsum(n_per_group) - n_per_group, n_per_group)
+
+        return group_idx['positions'][group_offsets + within_group]
+
+    def group_prefix_count(self, group_cols: list, target_values):
+        group_idx = self.group_index(group_cols)
+
+        if 'prefix_sum' not in group_idx:
+            sorted_values = self.data[self.sort_col].to_numpy(
+                dtype=float, na_value=0)[group_idx['positions']]
+            group_idx['prefix_sum'] = np.concatenate(
+                [[0], np.cumsum(sorted_values)])
+
+        # Prefix sums only grow while the sorted values are non-negative.
+        prefix_sum = group_idx['prefix_sum']
+        starts = group_idx['starts']
+        group_counts = np.searchsorted(
+            prefix_sum, prefix_sum[starts] + np.asarray(target_values, dtype=float),
+            side='left') - starts
+
+        return np.clip(group_counts, 0, group_idx['sizes'])
+
+    def group_members(self, group_cols: list, group_mask):
+        group_idx = self.group_index(group_cols)
+        return self.group_top(group_cols, np.where(group_mask, group_idx['sizes'], 0))
@@ -1,35 +1,149 @@
+import numpy as np
 import pandas as pd
+from app_modules.ranking_module import RankIndex
 
 
 class DataFrameReplacer:
 
-    def __init__(self, fulldf, fracdf, sort_col: str = 'ACV'):
-        o_df = fulldf.copy()
-        s_df = fracdf.copy()
+    def __init__(self, fulldf, fracdf, sort_col: str = 'ACV',
+                 rank_index: RankIndex = None):
+        o_df = fulldf
+        s_df = fracdf
         col_n = list(o_df.columns.values)
-        original_rows = o_df.index.values.tolist()
-        used_rows = s_df.index.values.tolist()
-        unused_rows = [item for item in original_rows
-                       if item not in used_rows]
-        ws_df = o_df.filter(items=unused_rows, axis=0)
-        if sort_col == '':
-            ws_df = ws_df
-        else:
-            ws_df = ws_df.sort_values(by=sort_col, ascending=False)
+        unused_mask = ~o_df.index.isin(s_df.index)
 
         self.fulldf = fulldf
         self.fracdf = fracdf
+        self.sort_col = sort_col
+        self.rank_index = rank_index
         self.o_df = o_df
         self.s_df = s_df
         self.col_n = col_n
-        self.ws_df = ws_df
+        self.unused_mask = unused_mask
+        self.unused_positions = np.flatnonzero(unused_mask)
+        self.ws_df = None
+        self.candidate_indexes = {}
+
+    def sort_rank_index(self):
+        if self.rank_index is None:
+            self.rank_index = RankIndex(self.o_df, sort_col=self.sort_col)
+        return self.rank_index
+
+    def unused_pool(self):
+        if self.ws_df is None:
+            self.ws_df = self.o_df.take(
+                self.sort_rank_index().top(mask=self.unused_mask))
+        return self.ws_df
+
+    def candidate_index(self, est_col: list):
+        est_key = tuple(est_col)
+
+        if est_key not in self.candidate_indexes:
+            rank_index = self.sort_rank_index()
+            if est_key == ():
+                group_positions = rank_index.order[self.unused_mask[rank_index.order]]
+                group_keys = [()]
+                group_sizes = np.array([len(group_positions)])
+            else:
+                group_idx = rank_index.group_index(list(est_col))
+
+                # Keep only unused rows; each group stays ranked by sort_col.
+                group_positions = group_idx['positions']
+                group_positions = group_positions[self.unused_mask[group_positions]]
+                group_keys = group_idx['keys'].itertuples(index=False, name=None)
+                group_sizes = np.bincount(group_idx['codes'][group_positions],
+                                          minlength=group_idx['keys'].shape[0])
+            group_starts = np.cumsum(group_sizes) - group_sizes
+
+            candidate_idx = {
+                'lookup': {key: code for code, key in enumerate(group_keys)
+                           if group_sizes[code] > 0},
+                'positions': group_positions,
+                'starts': group_starts,
+                'ends': group_starts + group_sizes}
+
+            if self.sort_col != '':
+                # Missing sort values rank last, so each group's valued rows come first.
+                group_values = self.o_df[self.sort_col].to_numpy(
+                    dtype=float, na_value=np.nan)[group_positions]
+                candidate_idx['values'] = group_values
+                candidate_idx['descending_keys'] = -group_values
+                candidate_idx['value_ends'] = group_starts + np.bincount(
+                    np.repeat(np.arange(len(group_sizes)), group_sizes),
+                    weights=~np.isnan(group_values),
+                    minlength=len(group_sizes)).astype(np.int64)
+
+            self.candidate_indexes[est_key] = candidate_idx
+
+        return self.candidate_indexes[est_key]
+
+    @staticmethod
+    def pop_candidate(positions, cursor: int, end: int, taken):
+        while cursor < end and taken[positions[cursor]]:
+            cursor += 1
+        if cursor == end:
+            return None, cursor
+        taken[positions[cursor]] = True
+        return positions[cursor], cursor + 1
+
+    @staticmethod
+    def free_slot(next_slot, slot: int):
+        root = slot
+        while next_slot[root] != root:
+            root = next_slot[root]
+        while next_slot[slot] != root:
+            next_slot[slot], slot = root, next_slot[slot]
+        return root
+
+    def nearest_candidate(self, candidate_idx: dict, level_state: dict, code: int,
+                          value: float, taken):
+        positions = candidate_idx['positions']
+        values = candidate_idx['values']
+        start = candidate_idx['starts'][code]
+        value_end = candidate_idx['value_ends'][code]
+
+        if 'right_slot' not in level_state:
+            # Skip lists over the candidate slots: right_slot[i] leads to the first
+            # free slot >= i and left_slot[i + 1] to the last free slot <= i.
+            level_state['right_slot'] = np.arange(len(positions) + 1)
+            level_state['left_slot'] = np.arange(len(positions) + 1)
+        right_slot = level_state['right_slot']
+        left_slot = level_state['left_slot']
+
+        # Values are in descending order, so search their negation.
+        insert = start + np.searchsorted(
+            candidate_idx['descending_keys'][start:value_end], -value)
+        while True:
+            right = self.free_slot(right_slot, insert)
+            left = self.free_slot(left_slot, insert) - 1
+            right = right if right < value_end else None
+            left = left if left >= start else None
+            if right is None and left is None:
+                return None
+
+            stale = [slot for slot in (left, right)
+                     if slot is not None and taken[positions[slot]]]
+            if stale:
+                for slot in stale:
+                    right_slot[slot] = slot + 1
+                    left_slot[slot + 1] = slot
+                continue
+
+            if right is None or (left is not None and
+                                 abs(values[left] - value) <= abs(values[right] - value)):
+                slot = left
+            else:
+                slot = right
+            right_slot[slot] = slot + 1
+            left_slot[slot + 1] = slot
+            taken[positions[slot]] = True
+            return positions[slot]
 
     def rmv_sts(self, est_col: list, rmv_list: list,
                 id_rmv: str = 'SHO_ID'):
-        rmv_s_df = self.s_df.copy()
-        in_s_df = self.s_df.copy()
-        rmv_s_df = rmv_s_df[rmv_s_df[id_rmv].isin(rmv_list)]
-        in_s_df = in_s_df[~in_s_df[id_rmv].isin(rmv_list)]
+        rmv_mask = self.s_df[id_rmv].isin(rmv_list)
+        rmv_s_df = self.s_df[rmv_mask]
+        in_s_df = self.s_df[~rmv_mask]
         stc_rmv_df = rmv_s_df[est_col]
         stc_dic = stc_rmv_df.to_dict('list')
 
@@ -42,11 +156,10 @@ class DataFrameReplacer:
         return self.in_s_df
 
     def add_sts(self, est_col: list, rmv_list: list,
-                id_rmv: str = 'SHO_ID'):
-        rmv_s_df = self.s_df.copy()
-        in_s_df = self.s_df.copy()
-        rmv_s_df = rmv_s_df[rmv_s_df[id_rmv].isin(rmv_list)]
-        in_s_df = in_s_df[~in_s_df[id_rmv].isin(rmv_list)]
+                id_rmv: str = 'SHO_ID', hierarchical: bool = True, mode: str = 'top'):
+        rmv_mask = self.s_df[id_rmv].isin(rmv_list)
+        rmv_s_df = self.s_df[rmv_mask]
+        in_s_df = self.s_df[~rmv_mask]
         stc_rmv_df = rmv_s_df[est_col]
         stc_dic = stc_rmv_df.to_dict('list')
 
@@ -59,25 +172,53 @@ class DataFrameReplacer:
     #    return self.in_s_df
 
     # def add_sts(self):
-        add_df = pd.DataFrame(columns=self.col_n)
-        l = len(self.est_col)
-
-        for row in range(0, self.rmv_s_df.shape[0]):
-            temp_df = self.ws_df.copy()
-            for i in range(l):
-                crit_a = temp_df[self.est_col[i]]
-                crit_b = self.stc_dic[self.est_col[i]][row]
-                temp_df = temp_df[crit_a == crit_b]
-                if temp_df.empty:
+        if mode not in ['top', 'nearest']:
+            raise ValueError(f"Unknown replacement mode {mode!r}; use 'top' or 'nearest'.")
+        if mode == 'nearest' and self.sort_col == '':
+            print("The 'nearest' mode needs a sort column; replacing with the top candidates.")
+            mode = 'top'
+
+        # Fall back through shorter est_col prefixes, then the global pool.
+        level_cols = [self.est_col[:n_cols] for n_cols in range(len(self.est_col), 0, -1)]
+        if not hierarchical:
+            level_cols = level_cols[:1]
+        level_indexes = []
+        for cols in level_cols + [[]]:
+            candidate_idx = self.candidate_index(cols)
+            level_indexes.append((len(cols), candidate_idx,
+                                  {'cursors': candidate_idx['starts'].copy()}))
+
+        if mode == 'nearest':
+            rmv_values = self.rmv_s_df[self.sort_col].to_numpy(dtype=float, na_value=np.nan)
+        taken = ~self.unused_mask
+
+        add_positions = []
+        add_levels = []
+        for row, key in enumerate(self.stc_rmv_df.itertuples(index=False, name=None)):
+            position = None
+            for n_cols, candidate_idx, level_state in level_indexes:
+                code = candidate_idx['lookup'].get(key[:n_cols])
+                if code is None:
+                    continue
+                if mode == 'nearest' and not np.isnan(rmv_values[row]):
+                    position = self.nearest_candidate(candidate_idx, level_state, code,
+                                                      rmv_values[row], taken)
+                if position is None:
+                    position, level_state['cursors'][code] = self.pop_candidate(
+                        candidate_idx['positions'], level_state['cursors'][code],
+                        candidate_idx['ends'][code], taken)
+                if position is not None:
+                    add_positions.append(position)
+                    add_levels.append('+'.join(map(str, self.est_col[:n_cols])) or 'Global')
                     break
-            if temp_df.empty:
-                ta_df = self.ws_df.iloc[0]
-            else:
-                ta_df = temp_df.iloc[0]
-            add_df = pd.concat([add_df, ta_df.to_frame().transpose()])
+        if len(add_positions) < self.stc_rmv_df.shape[0]:
+            print(f'Only {len(add_positions)} of {self.stc_rmv_df.shape[0]} removed items '
+                  'could be replaced; the unused pool is exhausted.')
+        add_df = self.o_df.take(add_positions)
         n_s_df = pd.concat([self.in_s_df, add_df])
 
         self.add_df = add_df
+        self.add_levels = add_levels
         self.n_s_df = n_s_df
 
         return self.n_s_df
@@ -0,0 +1,221 @@
+import streamlit as st
+import pandas as pd
+from streamlit_option_menu import option_menu
+from streamlit_extras.switch_page_button import switch_page
+from PIL import Image
+import time
+import numpy as np
+from app_modules import niv_sample_selection as nss
+
+# DO_NOT_CHANGE########################################################
+#######################################################################
+
+st.set_page_config(
+    page_title='NIQ APP | NIV Sampling',
+    layout='centered',
+    initial_sidebar_state='collapsed'
+)
+
+hide_menu_style = """
+        <style>
+        #MainMenu {visibility: display;}
+        </style>
+        """
+st.markdown(hide_menu_style, unsafe_allow_html=True)
+
+image = Image.open('images_main/NIQ_banner.png')
+
+st.image(image, use_column_width='always', output_format='PNG')
+
+selected = option_menu(
+    menu_title=None,
+    options=['Home', 'Sampling', 'Replacing', ''],
+    icons=['house', 'calculator', 'archive', 'arrow-left-circle-fill'],
+    menu_icon='cast',
+    default_index=1,
+    orientation='horizontal',
+    styles={
+        "container": {"padding": "0!important",
+                      "background-color": "#fafafa"},
+        "icon": {"color": "#31d1ff", "font-size": "15px"},
+        "nav-link": {"color": "#31333F", "font-size": "15px",
+                     "text-align": "centered",
+                     "margin": "0px", "--hover-color": "#eee"},
+        "nav-link-selected": {"color": "#FFFFFF",
+                              "background-color": "#090a47"},
+    }
+)
+
+
+if selected == 'Home':
+    switch_page('NIQ p app')
+
+if selected == '':
+    switch_page('Sindex')
+
+if selected == 'Sampling':
+    subhead_app_5 = '''
+    <style>
+    .subhead-item {
+        backgroundcolor: transparent;
+    }
+    .subhead-item:hover {
+        color: #2E6EF7;
+    }
+    </style>
+
+    <a style='display: inline; text-align: left; color: #31333F
+    ; text-decoration: none; '
+    href="/NIV_sampling" target="_self">
+    <h3 class="subhead-item">
+    NIV Sampling
+    </h3>
+    </a>
+    '''
+    st.write(subhead_app_5, unsafe_allow_html=True)
+
+    with st.expander('Expand this section to upload your universe. When you finish you can collapse it again.'):
+        st.write(
+            'Upload the CSV or XLSX file that contains the universe Dataframe:')
+        uploaded_file = st.file_uploader("Choose a file",
+                                         type=['csv', 'xlsx'],
+                                         key='niv_settings_df'
+                                         )
+        if uploaded_file is not None:
+            # Parse each upload once; the page reruns while a selection is polled.
+            file_key = (uploaded_file.name, uploaded_file.size)
+            if st.session_state.get('niv_file_key') != file_key:
+                try:
+                    o_df = pd.read_csv(uploaded_file, encoding='UTF8')
+                except:
+                    o_df = pd.read_excel(uploaded_file)
+                st.session_state['niv_file_key'] = file_key
+                st.session_state['niv_df'] = o_df
+            o_df = st.session_state['niv_df']
+            file_name_df = uploaded_file.name.replace(
+                '.csv', '').replace('.xlsx', '')
+            st.write(o_df.head(100))
+
+    st.markdown('')
+
+    if uploaded_file is None:
+        st.caption('<p style="color: #2e6ef7;">Please upload a universe to continue.</p>',
+                   unsafe_allow_html=True)
+
+    if uploaded_file is not None:
+        col_par_1, col_par_2, col_par_3 = st.columns(3, gap='medium')
+        with col_par_1:
+            parameter_acv = st.number_input(r'Target **ACV** share:', min_value=0.0,
+                                            max_value=1.0, value=0.5, step=0.05)
+            structure = st.selectbox('Preserve the structure by:',
+                                     ['Cities', 'Universe'])
+        with col_par_2:
+            parameter_stores = st.number_input(r'Target **Stores** share:', min_value=0.0,
+                                               max_value=1.0, value=0.3, step=0.05)
+            reduction = st.selectbox('Select the principal cities by:',
+                                     ['ACV', 'Stores'])
+        with col_par_3:
+            cities_weight = st.number_input(r'Principal **cities** coverage:', min_value=0.0,
+                                            max_value=1.0, value=0.8, step=0.05)
+            sample_method = st.selectbox('Sample method:',
+                                         list(nss.NIV_Selection_Job.sample_methods))
+
+        st.write('')
+        niv_job = st.session_state.get('niv_job')
+        job_running = niv_job is not None and niv_job.is_running()
+
+        col_run_1, col_run_2, col_run_3 = st.columns([1, 5, 1], gap='medium')
+        with col_run_2:
+            if st.button(':inbox_tray: Press here to run the NIV sample selection :inbox_tray:',
+                         disabled=job_running):
+                niv_job = nss.NIV_Selection_Job(o_df, parameter_acv=parameter_acv, parameter_stores=parameter_stores,
+                                                structure=structure.lower(), reduction=reduction.lower(),
+                                                cities_weight=cities_weight, sample_method=sample_method)
+                st.session_state['niv_job'] = niv_job.start()
+
+        if niv_job is not None:
+            if niv_job.is_running():
+                st.progress(niv_job.progress, text=f'{niv_job.status}...')
+                if niv_job.cancel_event.is_set():
+                    st.caption('<p style="color: #2e6ef7;">Cancelling after the current step finishes.</p>',
+                               unsafe_allow_html=True)
+                elif st.button('Cancel the selection'):
+                    niv_job.cancel()
+                time.sleep(1)
+                st.rerun()
+
+            elif niv_job.status == 'Done':
+                niv_sample_df = niv_job.result
+                st.write(
+                    f'Sample of {niv_sample_df.shape[0]} stores in {niv_sample_df.City_ID.nunique()} cities, '
+                    f'covering {np.round((niv_sample_df.ACV.sum() / niv_job.data.ACV.sum()) * 100, 2)} % '
+                    f'of the universe ACV ({np.round(niv_job.elapsed, 1)} s):')
+                st.write(niv_sample_df)
+                niv_sample_df_csv = niv_sample_df.to_csv(index=False)
+                coldos_niv_1, coldos_niv_2 = st.columns(2, gap='medium')
+                with coldos_niv_2:
+                    st.download_button(label=':floppy_disk: Download Dataframe as CSV :floppy_disk:',
+                                       data=niv_sample_df_csv,
+                                       file_name=f'NIV_SAMPLE_{file_name_df}.csv',
+                                       mime='text/csv')
+
+            elif niv_job.status == 'Cancelled':
+                st.caption('<p style="color: #2e6ef7;">The NIV sample selection was cancelled.</p>',
+                           unsafe_allow_html=True)
+
+            elif niv_job.status == 'Failed':
+                st.caption(f'<p style="color: #2e6ef7;">The NIV sample selection failed: {niv_job.error}</p>',
+                           unsafe_allow_html=True)
+
+
+if selected == 'Replacing':
+    switch_page('Replacing')
+
+#######################################################################
+
+ft = """
+<style>
+a:link , a:visited{
+color: #808080;  /* theme's text color at 75 percent brightness*/
+background-color: transparent;
+text-decoration: none;
+}
+
+a:hover,  a:active {
+color: #0283C3; /* theme's primary color*/
+background-color: transparent;
+text-decoration: underline;
+}
+
+#page-container {
+  position: relative;
+  min-height: 10vh;
+}
+
+footer{
+    visibility:hidden;
+}
+
+.footer {
+position: relative;
+left: 0;
+top:230px;
+bottom: 0;
+width: 100%;
+background-color: transparent;
+color: #BFBFBF; /* theme's text color at 50 percent brightness*/
+text-align: left; /* 'left', 'center' or 'right' if you want*/
+}
+</style>
+<div id="page-container">
+<div class="footer">
+<p style='font-size: 0.875em;'>Developed by <a style='display: inline;
+text-align:
+left;' href="https://github.com/sape94" target="_blank">
+<img src="https://i.postimg.cc/vBnHmZfF/innovation-logo.png"
+alt="AI" height= "20"/><br>LatAm's Automation & Innovation Team.
+</br></a>Version 1.4.1-b.1.</p>
+</div>
+</div>
+"""
+st.write(ft, unsafe_allow_html=True)
@@ -169,6 +169,44 @@ if selected == 'Sampling':
         unsafe_allow_html=True)
     st.header('')
 
+    subhead_app_5 = '''
+    <style>
+    .subhead-item {
+        backgroundcolor: transparent;
+    }
+    .subhead-item:hover {
+        color: #2E6EF7;
+    }
+    </style>
+
+    <a style='display: inline; text-align: left; color: #31333F
+    ; text-decoration: none; '
+    href="/NIV_sampling" target="_self">
+    <h3 class="subhead-item">
+    NIV Sampling
+    </h3>
+    </a>
+    '''
+    st.write(subhead_app_5, unsafe_allow_html=True)
+    app_5_topic = 'Description'
+    st.write(
+        f'''<div style="text-align: left; color: #31d1ff;">
+        {app_5_topic}</div>''',
+        unsafe_allow_html=True)
+    app_5_cap = f'''
+    By uploading a store universe you can design and select an NIV sample
+    by providing the ACV and Stores targets and the principal cities coverage.
+    The selection runs in the background with a progress bar, it can be cancelled,
+    and the sample can be downloaded when it finishes.
+    '''
+    st.caption(
+        f'''
+        <div style="text-align: justify;
+        margin-top: 5px;
+        ">{app_5_cap}</div>''',
+        unsafe_allow_html=True)
+    st.header('')
+
     subhead_app_7 = '''
     <style>
     .subhead-item {